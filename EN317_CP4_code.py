@@ -68,9 +68,214 @@ c_fluid:                                cooling fluid
 Mwater:                                 cooling fluid flow rate
 
 '''
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import CoolProp.CoolProp as CP
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.stats import qmc
+
+
+#Warm-Started Flash Calculations
+#P-H and P-S flashes (t from h, h from s) are solved by Newton iteration on T with P-T updates, starting
+#from the last converged T and density of the same stream. In sweeps and profiles each point is next to
+#the previous one, so this converges in a few P-T updates; the last ones are plain P-T updates without the
+#density guess. Steps are limited to max_step, and once the error changes sign the step stays inside the
+#bracket (bisecting if Newton leaves it). If there is no guess yet, or Newton fails (e.g. the error grows at
+#the cp spike near the critical point), the flash falls back to a cold CoolProp flash.
+class WarmStartFlash:
+
+    def __init__(self, w_fluid = 'CO2', max_iter = 8, h_tol = 1e-3, s_tol = 1e-6, max_step = 50):
+        self.state = CP.AbstractState('HEOS', w_fluid)
+        self.max_iter = max_iter
+        self.max_step = max_step    #K
+        self.h_tol = h_tol
+        self.s_tol = s_tol
+        self.guesses = {}       #stream -> (T, rhomolar) of the last converged flash
+        self.calls = {}
+        self.iterations = {}    #P-T updates spent in warm-started flashes
+        self.cold_starts = {}
+
+    def T_PH(self, stream, p, h):
+        self.flash(stream, p, h, 'H')
+        return self.state.T()
+
+    def h_PS(self, stream, p, s):
+        self.flash(stream, p, s, 'S')
+        return self.state.hmass()
+
+    def flash(self, stream, p, target, prop):
+        self.calls[stream] = self.calls.get(stream, 0) + 1
+        if stream in self.guesses and self.newton(stream, p, target, prop):
+            self.guesses[stream] = (self.state.T(), self.state.rhomolar())
+            return
+
+        self.cold_starts[stream] = self.cold_starts.get(stream, 0) + 1
+        if prop == 'H':
+            self.state.update(CP.HmassP_INPUTS, target, p)
+        else:
+            self.state.update(CP.PSmass_INPUTS, p, target)
+        self.guesses[stream] = (self.state.T(), self.state.rhomolar())
+
+    def newton(self, stream, p, target, prop):
+        T, rhomolar = self.guesses[stream]
+        guess = CP.PyGuessesStructure()
+        T_low, T_high = self.state.Tmin(), self.state.Tmax()    #bracket, h and s rise with T
+        last_error = None
+        exact = False
+        for i in range(self.max_iter):
+            try:
+                if exact:
+                    self.state.update(CP.PT_INPUTS, p, T)
+                else:
+                    guess.rhomolar = rhomolar
+                    self.state.update_with_guesses(CP.PT_INPUTS, p, T, guess)
+            except ValueError:
+                break
+            self.iterations[stream] = self.iterations.get(stream, 0) + 1
+
+            if prop == 'H':
+                error = self.state.hmass() - target
+                slope = self.state.cpmass()
+                tol = self.h_tol
+            else:
+                error = self.state.smass() - target
+                slope = self.state.cpmass() / T
+                tol = self.s_tol
+            if exact and abs(error) < tol:
+                return True
+            if last_error is not None and error * last_error > 0 and abs(error) > abs(last_error):
+                break       #diverging without a bracket, a cold flash is cheaper than more iterations
+
+            step = float(np.clip(-error / slope, -self.max_step, self.max_step))
+            if not exact and abs(step) < 1e-3:
+                # Updates with a density guess are only accurate to ~1e-8 in h, and a guess from far away
+                # (e.g. from inside the dome) can converge on a spurious root of the equation of state.
+                # The last steps use plain P-T updates, which are exact at T, with a fresh bracket.
+                exact = True
+                T_low, T_high, last_error = self.state.Tmin(), self.state.Tmax(), None
+            else:
+                last_error = error
+                if error < 0:
+                    T_low = T
+                else:
+                    T_high = T
+            T = T + step if T_low <= T + step <= T_high else (T_low + T_high) / 2
+            rhomolar = self.state.rhomolar()
+        return False
+
+    def report(self, title):
+        print(title, "flash iterations (P-T updates per call, cold starts):")
+        for stream in self.calls:
+            print("  ", stream, ":", round(self.iterations.get(stream, 0) / self.calls[stream], 2), 'per call,',
+                  self.cold_starts.get(stream, 0), 'cold starts of', self.calls[stream])
+        print()
+
+#T-s Diagram Background
+#Saturation dome and isobars are computed with one vectorized CoolProp call per curve and cached,
+#in memory and in ts_cache_file next to this script, so plotting many cycles only computes the process paths.
+#Isobars are stored as (T, s, h) tables on ts_T_grid; new fluids and pressures are added to the cache file as
+#they are needed, and cached isobars are dropped if ts_T_grid has changed since they were saved.
+
+ts_cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ts_background_cache.npz')
+ts_T_grid = np.linspace(250, 1000, 2000)
+ts_cache = {}
+
+
+def ts_background(pressures, w_fluid = 'CO2', cache_file = ts_cache_file):
+    if not ts_cache and os.path.exists(cache_file):
+        with np.load(cache_file) as stored:
+            ts_cache.update({key: stored[key] for key in stored.files})
+        if 'T_grid' not in ts_cache or not np.array_equal(ts_cache['T_grid'], ts_T_grid):
+            ts_cache.clear()
+
+    changed = False
+    dome_key = w_fluid + '_dome'
+    if dome_key not in ts_cache:
+        T_sat = np.linspace(CP.PropsSI('Ttriple', w_fluid), CP.PropsSI('Tcrit', w_fluid) - 0.01, 200)
+        s_liq = CP.PropsSI('S', 'T', T_sat, 'Q', 0, w_fluid)
+        s_vap = CP.PropsSI('S', 'T', T_sat, 'Q', 1, w_fluid)
+        ts_cache[dome_key] = np.array([np.concatenate([s_liq, s_vap[::-1]]), np.concatenate([T_sat, T_sat[::-1]])])
+        changed = True
+
+    isobar_keys = {p: w_fluid + '_isobar_' + str(int(round(p))) for p in pressures}
+    for p, key in isobar_keys.items():
+        if key not in ts_cache:
+            ts_cache[key] = np.array([ts_T_grid, CP.PropsSI('S', 'P', p, 'T', ts_T_grid, w_fluid),
+                                      CP.PropsSI('H', 'P', p, 'T', ts_T_grid, w_fluid)])
+            changed = True
+
+    if changed:
+        ts_cache['T_grid'] = ts_T_grid
+        np.savez(cache_file, **ts_cache)
+
+    return ts_cache[dome_key], {p: ts_cache[key] for p, key in isobar_keys.items()}
+
+
+def ts_process_paths(h, p5 = 250*100000, p6 = 90*100000, p8 = 120*100000, n = 20, w_fluid = 'CO2'):
+    h1, h2, h3, h4, h5, h6, h7, h8, h9 = h
+    dome, isobars = ts_background([p5, p6, p8], w_fluid)
+
+    # Heat exchangers are isobaric: read T and s straight off the cached isobar tables
+    def isobaric(h_in, h_out, p):
+        T, s, h_table = isobars[p]
+        h_path = np.linspace(h_in, h_out, n)
+        return np.interp(h_path, h_table, s), np.interp(h_path, h_table, T)
+
+    # Turbomachinery: pressure changes geometrically and enthalpy linearly between inlet and outlet,
+    # one P-H flash per path point gives both T and s
+    state = CP.AbstractState('HEOS', w_fluid)
+    machines = [(h1, h2, p8, p5), (h5, h6, p5, p6), (h7, h8, p6, p8)]
+    T_machines = np.empty((3, n))
+    s_machines = np.empty((3, n))
+    for i, (h_in, h_out, p_in, p_out) in enumerate(machines):
+        for j, (P, H) in enumerate(zip(np.geomspace(p_in, p_out, n), np.linspace(h_in, h_out, n))):
+            state.update(CP.HmassP_INPUTS, H, P)
+            T_machines[i, j] = state.T()
+            s_machines[i, j] = state.smass()
+
+    return {'1-2 Compressor': (s_machines[0], T_machines[0]),
+            '2-3 LTR cold': isobaric(h2, h3, p5),
+            '3-4 HTR cold': isobaric(h3, h4, p5),
+            '4-5 Heater': isobaric(h4, h5, p5),
+            '5-6 Turbine': (s_machines[1], T_machines[1]),
+            '6-7 HTR hot': isobaric(h6, h7, p6),
+            '7-8 Precompressor': (s_machines[2], T_machines[2]),
+            '8-9 LTR hot': isobaric(h8, h9, p8),
+            '9-1 Cooler': isobaric(h9, h1, p8)}
+
+
+def plot_ts_background(ax, p5 = 250*100000, p6 = 90*100000, p8 = 120*100000, w_fluid = 'CO2'):
+    dome, isobars = ts_background([p5, p6, p8], w_fluid)
+    ax.plot(dome[0], dome[1], color='k', linewidth=1, label='Saturation dome')
+    # Labels sit right of their isobar at the hot end, away from the cycle points. Going from the highest
+    # pressure (leftmost isobar) down, each is placed lower, so no two share a row
+    for k, p in enumerate(sorted(isobars, reverse=True)):
+        T, s, h = isobars[p]
+        ax.plot(s, T, color='grey', linewidth=0.7, linestyle='dotted')
+        i = np.searchsorted(T, 950 - 80*k)
+        ax.text(s[i], T[i], str(round(p/100000)) + ' bar', fontsize=8, color='grey', ha='left', va='top')
+
+
+def plot_ts_cycle(ax, h, p5 = 250*100000, p6 = 90*100000, p8 = 120*100000, color = 'b', points = True,
+                  w_fluid = 'CO2'):
+    for s_path, T_path in ts_process_paths(h, p5, p6, p8, w_fluid = w_fluid).values():
+        ax.plot(s_path, T_path, color=color, linewidth=1)
+    if points:
+        h_points = list(h)
+        p_points = [p8, p5, p5, p5, p5, p6, p6, p8, p8]
+        T_points = CP.PropsSI('T', 'P', p_points, 'H', h_points, w_fluid)
+        s_points = CP.PropsSI('S', 'P', p_points, 'H', h_points, w_fluid)
+        ax.scatter(s_points, T_points, color=color, zorder=3)
+        for i in range(9):
+            ax.text(s_points[i], T_points[i], i + 1, va='bottom', ha='center')
+
+
 
 #Assumed Parameters
 Wt = 100*1000000      #Turbine work output
@@ -344,22 +549,17 @@ print("effectiveness of cooler (using Cp) = ", round(effec_cooler_calc_Cp, 4), '
 
 #T-s plot
 
-
-y=[t1,t2,t3,t4,t5,t6,t7,t8,t9,t1]
-x=[s1,s2,s3,s4,s5,s6,s7,s8,s9,s1]
-plt.scatter(x, y,)
-plt.plot(x, y, linestyle = 'dashed',)
-plt.ylabel('Temperature (K)')
-plt.xlabel('Entropy (J/kg.K)')
-i=1
-for (xi, yi) in zip(x, y):
-    if (i<10):
-        plt.text(xi, yi, i, va='bottom', ha='center')
-        i=i+1
-plt.grid()
+fig, ax = plt.subplots(figsize=(8, 6))
+plot_ts_background(ax, p5, p6, p8)
+plot_ts_cycle(ax, [h1, h2, h3, h4, h5, h6, h7, h8, h9], p5, p6, p8)
+ax.set_ylabel('Temperature (K)')
+ax.set_xlabel('Entropy (J/kg.K)')
+ax.set_title('T-s Diagram')
+ax.grid(True)
 plt.show()
 
 #HTR Temperature Profile
+profile_flash = WarmStartFlash()
 Hc = h3
 Hh = h7
 n = 25
@@ -371,11 +571,11 @@ j_values = []
 j = 0
 while(j < n ):
     Hc += Qn/Mco2
-    Tc = CP.PropsSI('T', 'H', Hc, 'P', p3, 'CO2')
+    Tc = profile_flash.T_PH('HTR cold', p3, Hc)
     temperatures_cold_HTR.append(int(Tc)-273)
 
     Hh += Qn/Mco2
-    Th = CP.PropsSI('T', 'H', Hh, 'P', p6, 'CO2')
+    Th = profile_flash.T_PH('HTR hot', p6, Hh)
     temperatures_hot_HTR.append(int(Th)-273)
 
     j_values.append(j)
@@ -417,11 +617,11 @@ k_values = []
 k = 0
 while(k < m ):
     Hc_LTR += Qn_LTR/Mco2
-    Tc_LTR = CP.PropsSI('T', 'H', Hc_LTR, 'P', p2, 'CO2')
+    Tc_LTR = profile_flash.T_PH('LTR cold', p2, Hc_LTR)
     temperatures_cold_LTR.append(int(Tc_LTR)-273)
 
     Hh_LTR += Qn_LTR/Mco2
-    Th_LTR = CP.PropsSI('T', 'H', Hh_LTR, 'P', p8, 'CO2')
+    Th_LTR = profile_flash.T_PH('LTR hot', p8, Hh_LTR)
     temperatures_hot_LTR.append(int(Th_LTR)-273)
 
     k_values.append(k)
@@ -468,7 +668,7 @@ while(l < o ):
     temperatures_cold_cooler.append(int(Tc_cooler)-273)
 
     Hh_cooler += Qn_cooler/Mco2
-    Th_cooler = CP.PropsSI('T', 'H', Hh_cooler, 'P', p1, 'CO2')
+    Th_cooler = profile_flash.T_PH('cooler hot', p1, Hh_cooler)
     temperatures_hot_cooler.append(int(Th_cooler)-273)
 
     l_values.append(l)
@@ -476,6 +676,8 @@ while(l < o ):
 
 l_values.append(l)
 
+profile_flash.report("Temperature profiles")
+
 
 plt.figure(figsize = (8, 6))
 
@@ -506,6 +708,8 @@ t5_values = np.linspace(460 + 273, 660 + 273, 10)
 t5_values_plot = []
 E_cycle_values = []
 
+sweep_flash = WarmStartFlash()
+
 for t5 in t5_values:
     Wt = 100 * 1000000  # Turbine work output
 
@@ -574,9 +778,9 @@ for t5 in t5_values:
 
 
     # TURBINE
-    h6s = CP.PropsSI('H', 'P', p6, 'S', s5, w_fluid)
+    h6s = sweep_flash.h_PS('6s', p6, s5)
     h6 = h5 - (Et * (h5 - h6s))
-    t6 = CP.PropsSI('T', 'P', p6, 'H', h6, w_fluid)
+    t6 = sweep_flash.T_PH('6', p6, h6)
     s6 = CP.PropsSI('S', 'P', p6, 'T', t6, w_fluid)
 
 
@@ -588,35 +792,35 @@ for t5 in t5_values:
 
     h7 = h6 - (effec_HTR * (h6 - h_t3_p6))
 
-    t7 = CP.PropsSI('T', 'P', p7, 'H', h7, w_fluid)
+    t7 = sweep_flash.T_PH('7', p7, h7)
     s7 = CP.PropsSI('S', 'P', p7, 'T', t7, w_fluid)
 
 
     h4 = h3 + (h6 - h7)
 
-    t4 = CP.PropsSI('T', 'P', p4, 'H', h4, w_fluid)
+    t4 = sweep_flash.T_PH('4', p4, h4)
     s4 = CP.PropsSI('S', 'P', p4, 'T', t4, w_fluid)
 
 
     # Precompressor
-    h8s = CP.PropsSI('H', 'P', p8, 'S', s7, w_fluid)
+    h8s = sweep_flash.h_PS('8s', p8, s7)
     h8 = ((h8s - h7) / Epc) + h7
 
-    t8 = CP.PropsSI('T', 'P', p8, 'H', h8, w_fluid)
+    t8 = sweep_flash.T_PH('8', p8, h8)
     s8 = CP.PropsSI('S', 'P', p8, 'T', t8, w_fluid)
 
     # Compressor
-    h2s = CP.PropsSI('H', 'P', p2, 'S', s1, w_fluid)
+    h2s = sweep_flash.h_PS('2s', p2, s1)
     h2 = ((h2s - h1) / Ec) + h1
 
-    t2 = CP.PropsSI('T', 'P', p2, 'H', h2, w_fluid)
+    t2 = sweep_flash.T_PH('2', p2, h2)
     s2 = CP.PropsSI('S', 'P', p2, 'T', t2, w_fluid)
 
 
     # LTR
     h9 = h8 - (h3 - h2)
 
-    t9 = CP.PropsSI('T', 'P', p9, 'H', h9, w_fluid)
+    t9 = sweep_flash.T_PH('9', p9, h9)
     s9 = CP.PropsSI('S', 'P', p9, 'T', t9, w_fluid)
 
     # Stream 9
@@ -637,6 +841,8 @@ for t5 in t5_values:
     t5_values_plot.append(t5 - 273)
     E_cycle_values.append(E_cycle*100)
 
+sweep_flash.report("TIT sweep")
+
 #plotting E_cycle vs TIT
 
 plt.figure(figsize=(8, 6))
@@ -655,6 +861,8 @@ p5_values = np.linspace(200*100000, 300*100000, 10)
 p5_values_plot = []
 E_cycle_values = []
 
+sweep_flash = WarmStartFlash()
+
 for p5 in p5_values:
     Wt = 100 * 1000000  # Turbine work output
 
@@ -723,9 +931,9 @@ for p5 in p5_values:
 
 
     # TURBINE
-    h6s = CP.PropsSI('H', 'P', p6, 'S', s5, w_fluid)
+    h6s = sweep_flash.h_PS('6s', p6, s5)
     h6 = h5 - (Et * (h5 - h6s))
-    t6 = CP.PropsSI('T', 'P', p6, 'H', h6, w_fluid)
+    t6 = sweep_flash.T_PH('6', p6, h6)
     s6 = CP.PropsSI('S', 'P', p6, 'T', t6, w_fluid)
 
 
@@ -737,35 +945,35 @@ for p5 in p5_values:
 
     h7 = h6 - (effec_HTR * (h6 - h_t3_p6))
 
-    t7 = CP.PropsSI('T', 'P', p7, 'H', h7, w_fluid)
+    t7 = sweep_flash.T_PH('7', p7, h7)
     s7 = CP.PropsSI('S', 'P', p7, 'T', t7, w_fluid)
 
 
     h4 = h3 + (h6 - h7)
 
-    t4 = CP.PropsSI('T', 'P', p4, 'H', h4, w_fluid)
+    t4 = sweep_flash.T_PH('4', p4, h4)
     s4 = CP.PropsSI('S', 'P', p4, 'T', t4, w_fluid)
 
 
     # Precompressor
-    h8s = CP.PropsSI('H', 'P', p8, 'S', s7, w_fluid)
+    h8s = sweep_flash.h_PS('8s', p8, s7)
     h8 = ((h8s - h7) / Epc) + h7
 
-    t8 = CP.PropsSI('T', 'P', p8, 'H', h8, w_fluid)
+    t8 = sweep_flash.T_PH('8', p8, h8)
     s8 = CP.PropsSI('S', 'P', p8, 'T', t8, w_fluid)
 
     # Compressor
-    h2s = CP.PropsSI('H', 'P', p2, 'S', s1, w_fluid)
+    h2s = sweep_flash.h_PS('2s', p2, s1)
     h2 = ((h2s - h1) / Ec) + h1
 
-    t2 = CP.PropsSI('T', 'P', p2, 'H', h2, w_fluid)
+    t2 = sweep_flash.T_PH('2', p2, h2)
     s2 = CP.PropsSI('S', 'P', p2, 'T', t2, w_fluid)
 
 
     # LTR
     h9 = h8 - (h3 - h2)
 
-    t9 = CP.PropsSI('T', 'P', p9, 'H', h9, w_fluid)
+    t9 = sweep_flash.T_PH('9', p9, h9)
     s9 = CP.PropsSI('S', 'P', p9, 'T', t9, w_fluid)
 
     # Stream 9
@@ -786,6 +994,8 @@ for p5 in p5_values:
     p5_values_plot.append(p5/100000)
     E_cycle_values.append(E_cycle*100)
 
+sweep_flash.report("Turbine inlet pressure sweep")
+
 #plotting E_cycle vs turbine inlet pressure
 
 plt.figure(figsize=(8, 6))
@@ -796,3 +1006,854 @@ plt.grid(True)
 plt.title('Variation of Cycle Efficiency with Turbine Inlet Pressure (p5)')
 plt.show()
 
+
+
+
+#Cycle Model
+#Single operating point of the recompression cycle, same equations as the parametric studies above.
+#Any assumed parameter can be overridden by keyword, e.g. solve_cycle(t5 = 600 + 273, p6 = 80*100000)
+#Pass the same WarmStartFlash as flash to every call of a sweep or optimizer loop to warm start its flashes.
+def solve_cycle(Wt = 100*1000000, Et = 0.9, Ec = 0.85, Epc = 0.85,
+                p5 = 250*100000, p6 = 90*100000, p8 = 120*100000,
+                t5 = 560 + 273, t1 = 35 + 273, t3 = 264 + 273, effec_HTR = 0.8,
+                w_fluid = 'CO2', flash = None):
+
+    if flash is None:
+        flash = WarmStartFlash(w_fluid)
+
+    # PRESSURES
+    p7 = p6
+    p9 = p8
+    p1 = p9
+    p4 = p5
+    p3 = p4
+    p2 = p3
+
+    # Known enthalpies and entropies
+    h5 = CP.PropsSI('H', 'P', p5, 'T', t5, w_fluid)
+    s5 = CP.PropsSI('S', 'P', p5, 'T', t5, w_fluid)
+
+    h3 = CP.PropsSI('H', 'P', p3, 'T', t3, w_fluid)
+
+    h1 = CP.PropsSI('H', 'P', p1, 'T', t1, w_fluid)
+    s1 = CP.PropsSI('S', 'P', p1, 'T', t1, w_fluid)
+
+    # TURBINE
+    h6s = flash.h_PS('6s', p6, s5)
+    h6 = h5 - (Et * (h5 - h6s))
+
+    Mco2 = Wt / (h5 - h6)
+
+    # HTR
+    h_t3_p6 = CP.PropsSI('H', 'P', p6, 'T', t3, w_fluid)
+    h7 = h6 - (effec_HTR * (h6 - h_t3_p6))
+    t7 = flash.T_PH('7', p7, h7)
+    s7 = CP.PropsSI('S', 'P', p7, 'T', t7, w_fluid)
+
+    h4 = h3 + (h6 - h7)
+
+    # Precompressor
+    h8s = flash.h_PS('8s', p8, s7)
+    h8 = ((h8s - h7) / Epc) + h7
+
+    # Compressor
+    h2s = flash.h_PS('2s', p2, s1)
+    h2 = ((h2s - h1) / Ec) + h1
+
+    # LTR
+    h9 = h8 - (h3 - h2)
+
+    Wpc = Mco2 * (h8 - h7)  # Precomp work input
+    Wc = Mco2 * (h2 - h1)  # Compressor work input
+    Wnet = Wt - Wc - Wpc
+
+    E_cycle = Wnet / (Mco2 * (h5 - h4))  # Cycle efficiency
+
+    return {'E_cycle': E_cycle, 'Wnet': Wnet, 'Mco2': Mco2, 'Wc': Wc, 'Wpc': Wpc,
+            'Q_heater': Mco2 * (h5 - h4), 'Q_cooler': Mco2 * (h9 - h1),
+            'h': [h1, h2, h3, h4, h5, h6, h7, h8, h9]}
+
+
+
+#Adaptive Efficiency Map
+#Starts from a coarse grid over any two assumed parameters. Each cell is checked at its four edge midpoints
+#and its centre against the bilinear interpolation of its corners, and is split into four only where that
+#interpolation error is larger than tol. The checked points are the corners of the four sub-cells, so
+#nothing is evaluated twice. Where efficiency is smooth the cells stay coarse; near the pseudo-critical
+#region (t1, p8 close to the critical point at the compressor inlet) they are refined down to max_depth.
+def efficiency_map(x_name, x_range, y_name, y_range, n0 = 5, max_depth = 5, tol = 0.0003, **fixed):
+
+    values = {}     #evaluated points, reused by neighbouring cells
+    flash = WarmStartFlash()    #refinement visits neighbouring points one after another
+    finest = [0]        #finest uniform cell size needed anywhere, in cells per coarse cell
+
+    def E_at(x, y):
+        key = (round(x, 9), round(y, 9))
+        if key not in values:
+            try:
+                values[key] = solve_cycle(**{x_name: x, y_name: y}, **fixed, flash = flash)['E_cycle']
+            except ValueError:      #CoolProp flash failed, leave a hole in the map
+                values[key] = np.nan
+        return values[key]
+
+    def refine(x0, x1, y0, y1, depth):
+        xm = (x0 + x1) / 2
+        ym = (y0 + y1) / 2
+        E00, E10, E01, E11 = E_at(x0, y0), E_at(x1, y0), E_at(x0, y1), E_at(x1, y1)
+        interp_error = np.max(np.abs([E_at(xm, y0) - (E00 + E10) / 2,
+                                      E_at(xm, y1) - (E01 + E11) / 2,
+                                      E_at(x0, ym) - (E00 + E01) / 2,
+                                      E_at(x1, ym) - (E10 + E11) / 2,
+                                      E_at(xm, ym) - (E00 + E10 + E01 + E11) / 4]))
+        if depth < max_depth and interp_error > tol:
+            refine(x0, xm, y0, ym, depth + 1)
+            refine(xm, x1, y0, ym, depth + 1)
+            refine(x0, xm, ym, y1, depth + 1)
+            refine(xm, x1, ym, y1, depth + 1)
+        else:
+            # Interpolation error scales with the square of the cell size, so a uniform grid meets tol
+            # here with cells sqrt(interp_error/tol) times smaller than this one
+            finest[0] = max(finest[0], 2**depth * np.sqrt(interp_error / tol))
+
+    x_grid = np.linspace(x_range[0], x_range[1], n0)
+    y_grid = np.linspace(y_range[0], y_range[1], n0)
+    for i in range(n0 - 1):
+        for j in range(n0 - 1):
+            refine(x_grid[i], x_grid[i + 1], y_grid[j], y_grid[j + 1], 0)
+
+    # A uniform grid of equal accuracy needs the finest cells anywhere, plus their edge midpoints and centres.
+    # This is an estimate from the h^2 scaling above, not a measured grid, and it can overstate the count
+    points = np.array([[x, y, E] for (x, y), E in values.items() if not np.isnan(E)])
+    uniform_evaluations = (2 * int(np.ceil((n0 - 1) * finest[0])) + 1)**2
+    print("Efficiency map", x_name, "x", y_name, ":", len(values), "evaluations, uniform grid of equal accuracy:",
+          uniform_evaluations, "estimated (h^2 scaling) (", round(uniform_evaluations / len(values), 1), "x )", '\n')
+    flash.report("Efficiency map " + x_name + " x " + y_name)
+
+    return points[:, 0], points[:, 1], points[:, 2]
+
+
+#plotting efficiency maps (scattered points -> triangulated contours)
+
+map_cases = [('t5', (460 + 273, 660 + 273), 'p5', (200*100000, 300*100000), {},
+              lambda x: x - 273, lambda y: y/100000,
+              'Turbine Inlet Temperature (°C)', 'Turbine Inlet Pressure (bar)'),
+             ('t1', (32 + 273, 45 + 273), 'p8', (78*100000, 110*100000), {'p6': 75*100000},
+              lambda x: x - 273, lambda y: y/100000,
+              'Compressor Inlet Temperature (°C)', 'Precompressor Outlet Pressure (bar)')]
+
+for x_name, x_range, y_name, y_range, fixed, x_scale, y_scale, x_label, y_label in map_cases:
+    x_map, y_map, E_map = efficiency_map(x_name, x_range, y_name, y_range, **fixed)
+
+    plt.figure(figsize=(8, 6))
+    contours = plt.tricontourf(x_scale(x_map), y_scale(y_map), E_map*100, levels=20, cmap='viridis')
+    plt.colorbar(contours, label='Cycle Efficiency (%)')
+    plt.scatter(x_scale(x_map), y_scale(y_map), s=2, color='k')
+    plt.xlabel(x_label)
+    plt.ylabel(y_label)
+    plt.title('Cycle Efficiency Map (' + x_name + ' vs ' + y_name + ')')
+    plt.show()
+
+
+
+#Transient Simulation
+#Lumped thermal masses for the heater, HTR, LTR and cooler. Mco2 and the three cycle pressures
+#(p5, p6, p8) are held at their design values; the turbomachinery responds instantly.
+#The heater is driven either by a duty schedule (Q_heater_fn) or by a TIT setpoint (t5_fn), tracked by a
+#controller that sets the duty to the steady duty at the setpoint plus a correction that returns the metal
+#temperature to the setpoint with time constant tau_TIT. The two error terms have the same sign, so the
+#controller settles on the setpoint with no offset.
+#
+#States (all K):
+#   t5      heater metal temperature (CO2 leaves the heater at the metal temperature)
+#   t1      cooler metal temperature (CO2 leaves the cooler at the metal temperature)
+#   t4, t7  HTR cold and hot outlets, lagging the quasi-steady effectiveness outlet
+#   t3, t9  LTR cold and hot outlets, lagging the quasi-steady effectiveness outlet
+#
+#Properties come from h(T) and s(T) tables along each isobar, built with one CoolProp call per
+#isobar, so the right hand side is only np.interp and can be evaluated for many states at once.
+#np.interp clamps at the table ends, so the solution is checked against T_table afterwards.
+
+C_heater = 200000*500       #heater metal heat capacity (J/K) - 200 t of steel
+C_HTR = 100000*500          #HTR metal heat capacity (J/K)
+C_LTR = 80000*500           #LTR metal heat capacity (J/K)
+C_cooler = 30000*500        #cooler metal heat capacity (J/K)
+tau_TIT = 60                #TIT controller time constant (s)
+
+T_table = np.linspace(250, 1100, 3500)
+
+
+def isobar_table(p, w_fluid = 'CO2'):
+    return CP.PropsSI('H', 'P', p, 'T', T_table, w_fluid), CP.PropsSI('S', 'P', p, 'T', T_table, w_fluid)
+
+
+def simulate_transient(t_end, Q_heater_fn = None, t10_fn = None, Mwater_fn = None, t5_fn = None, t_eval = None,
+                       p5 = 250*100000, p6 = 90*100000, p8 = 120*100000,
+                       t10 = 20 + 273, t11 = 30 + 273, p10 = 1.36*100000, **design):
+
+    # Design point, used as initial condition and to size the heat exchangers
+    design_point = solve_cycle(p5 = p5, p6 = p6, p8 = p8, **design)
+    Et = design.get('Et', 0.9)
+    Ec = design.get('Ec', 0.85)
+    Epc = design.get('Epc', 0.85)
+    Mco2 = design_point['Mco2']
+    h1, h2, h3, h4, h5, h6, h7, h8, h9 = design_point['h']
+
+    # Isobar tables: high pressure (p2 = p3 = p4 = p5), turbine outlet (p6 = p7), precomp outlet (p8 = p9 = p1)
+    h_hi, s_hi = isobar_table(p5)
+    h_p6, s_p6 = isobar_table(p6)
+    h_p8, s_p8 = isobar_table(p8)
+
+    def T_of(h, h_tab):
+        return np.interp(h, h_tab, T_table)
+
+    def h_of(T, h_tab):
+        return np.interp(T, T_table, h_tab)
+
+    def h_isentropic(h_in, h_tab_in, s_tab_in, h_tab_out, s_tab_out):
+        s_in = np.interp(h_in, h_tab_in, s_tab_in)
+        return np.interp(s_in, s_tab_out, h_tab_out)
+
+    t1, t2, t3, t4, t5 = T_of(h1, h_p8), T_of(h2, h_hi), T_of(h3, h_hi), T_of(h4, h_hi), T_of(h5, h_hi)
+    t6, t7, t8, t9 = T_of(h6, h_p6), T_of(h7, h_p6), T_of(h8, h_p8), T_of(h9, h_p8)
+
+    # Heat exchanger sizing from the design point
+    effec_HTR = (h6 - h7) / (h6 - h_of(t3, h_p6))
+    effec_LTR = (h8 - h9) / (h8 - h_of(t2, h_p8))
+
+    Q_heater_design = Mco2 * (h5 - h4)
+    h10 = CP.PropsSI('H', 'P', p10, 'T', t10, 'Water')
+    h11 = CP.PropsSI('H', 'P', p10, 'T', t11, 'Water')
+    Mwater_design = Mco2 * (h9 - h1) / (h11 - h10)
+    Cp_water = (h11 - h10) / (t11 - t10)
+    effec_cooler_water = (t11 - t10) / (t1 - t10)
+
+    # Recuperator outlet time constants: metal heat capacity over stream capacity rate
+    tau_HTR_cold = C_HTR / (Mco2 * (h4 - h3) / (t4 - t3))
+    tau_HTR_hot = C_HTR / (Mco2 * (h6 - h7) / (t6 - t7))
+    tau_LTR_cold = C_LTR / (Mco2 * (h3 - h2) / (t3 - t2))
+    tau_LTR_hot = C_LTR / (Mco2 * (h8 - h9) / (t8 - t9))
+
+    if t5_fn is not None and Q_heater_fn is not None:
+        raise ValueError("Give either a heater duty (Q_heater_fn) or a TIT setpoint (t5_fn), not both")
+    if Q_heater_fn is None:
+        Q_heater_fn = lambda t: Q_heater_design
+    if t10_fn is None:
+        t10_fn = lambda t: t10
+    if Mwater_fn is None:
+        Mwater_fn = lambda t: Mwater_design
+
+    def streams(y):
+        t5, t1, t4, t7, t3, t9 = y
+        h5 = h_of(t5, h_hi)
+        h1 = h_of(t1, h_p8)
+
+        # Turbine
+        h6s = h_isentropic(h5, h_hi, s_hi, h_p6, s_p6)
+        h6 = h5 - (Et * (h5 - h6s))
+
+        # Precompressor
+        h7 = h_of(t7, h_p6)
+        h8s = h_isentropic(h7, h_p6, s_p6, h_p8, s_p8)
+        h8 = ((h8s - h7) / Epc) + h7
+
+        # Compressor
+        h2s = h_isentropic(h1, h_p8, s_p8, h_hi, s_hi)
+        h2 = ((h2s - h1) / Ec) + h1
+
+        return h1, h2, h_of(t3, h_hi), h_of(t4, h_hi), h5, h6, h7, h8, h_of(t9, h_p8)
+
+    def heater_duty(t, y):
+        if t5_fn is None:
+            return Q_heater_fn(t)
+        t5_set = t5_fn(t)
+        t5, t4 = y[0], y[2]
+        return Mco2 * (h_of(t5_set, h_hi) - h_of(t4, h_hi)) + C_heater * (t5_set - t5) / tau_TIT
+
+    def rhs(t, y):
+        t5, t1, t4, t7, t3, t9 = y
+        h1, h2, h3, h4, h5, h6, h7, h8, h9 = streams(y)
+
+        # Heater and cooler metal energy balances
+        dt5 = (heater_duty(t, y) - Mco2 * (h5 - h4)) / C_heater
+        Q_water = Mwater_fn(t) * Cp_water * effec_cooler_water * (t1 - t10_fn(t))
+        dt1 = (Mco2 * (h9 - h1) - Q_water) / C_cooler
+
+        # HTR, quasi-steady outlets from the effectiveness
+        Q_HTR = effec_HTR * (h6 - h_of(t3, h_p6))
+        dt4 = (T_of(h3 + Q_HTR, h_hi) - t4) / tau_HTR_cold
+        dt7 = (T_of(h6 - Q_HTR, h_p6) - t7) / tau_HTR_hot
+
+        # LTR
+        Q_LTR = effec_LTR * (h8 - h_of(T_of(h2, h_hi), h_p8))
+        dt3 = (T_of(h2 + Q_LTR, h_hi) - t3) / tau_LTR_cold
+        dt9 = (T_of(h8 - Q_LTR, h_p8) - t9) / tau_LTR_hot
+
+        return np.array([dt5, dt1, dt4, dt7, dt3, dt9])
+
+    y0 = np.array([t5, t1, t4, t7, t3, t9])
+    solution = solve_ivp(rhs, (0, t_end), y0, method = 'BDF', vectorized = True,
+                         t_eval = t_eval, rtol = 1e-6, atol = 1e-3)
+    if not solution.success:
+        raise RuntimeError("Transient simulation failed: " + solution.message)
+
+    # Every state and stream has to stay inside the property tables, otherwise it was given the table end properties
+    table_range = " left the property tables (" + str(T_table[0]) + " - " + str(T_table[-1]) + " K), widen T_table"
+    for name, T in zip(['t5', 't1', 't4', 't7', 't3', 't9'], solution.y):
+        if np.min(T) <= T_table[0] or np.max(T) >= T_table[-1]:
+            raise ValueError("State " + name + table_range)
+    h_tables = [h_p8, h_hi, h_hi, h_hi, h_hi, h_p6, h_p6, h_p8, h_p8]
+    for i, (h, h_tab) in enumerate(zip(streams(solution.y), h_tables)):
+        if np.min(h) <= h_tab[0] or np.max(h) >= h_tab[-1]:
+            raise ValueError("Stream " + str(i + 1) + table_range)
+
+    h1, h2, h3, h4, h5, h6, h7, h8, h9 = streams(solution.y)
+    Wt = Mco2 * (h5 - h6)
+    Wnet = Wt - Mco2 * (h2 - h1) - Mco2 * (h8 - h7)
+    E_cycle = Wnet / (Mco2 * (h5 - h4))
+    Q_heater = heater_duty(solution.t, solution.y) * np.ones_like(solution.t)
+
+    print("Transient simulation:", solution.nfev, "RHS evaluations,", solution.njev, "Jacobians,",
+          len(solution.t), "output points", '\n')
+
+    return {'time': solution.t, 't5': solution.y[0], 't1': solution.y[1], 't4': solution.y[2],
+            't7': solution.y[3], 't3': solution.y[4], 't9': solution.y[5],
+            'Wt': Wt, 'Wnet': Wnet, 'E_cycle': E_cycle, 'Q_heater': Q_heater}
+
+
+def ramp(t_start, t_stop, start_value, end_value):
+    return lambda t: start_value + (end_value - start_value) * np.clip((t - t_start) / (t_stop - t_start), 0, 1)
+
+
+#Heater ramp: 100 % -> 80 % duty over 10 minutes, 1 hour of plant time
+Q_heater_design = solve_cycle()['Q_heater']
+heater_ramp = simulate_transient(3600, Q_heater_fn = ramp(300, 900, Q_heater_design, 0.8*Q_heater_design),
+                                 t_eval = np.linspace(0, 3600, 361))
+
+#Cooling water upset: inlet temperature +5 K for 20 minutes
+cooling_upset = simulate_transient(3600, t10_fn = lambda t: 20 + 273 + 5*((t > 600) & (t < 1800)),
+                                   t_eval = np.linspace(0, 3600, 361))
+
+#TIT setpoint ramp: 560 -> 530 C over 10 minutes, heater duty set by the TIT controller
+TIT_ramp = simulate_transient(3600, t5_fn = ramp(300, 900, 560 + 273, 530 + 273), t_eval = np.linspace(0, 3600, 361))
+
+#plotting transient responses
+
+for result, title in [(heater_ramp, 'Heater Duty Ramp (100 % to 80 %)'),
+                      (cooling_upset, 'Cooling Water Inlet Temperature Upset (+5 K)'),
+                      (TIT_ramp, 'TIT Setpoint Ramp (560 to 530 °C)')]:
+    fig, axes = plt.subplots(3, 1, figsize=(8, 9), sharex=True)
+    minutes = result['time'] / 60
+
+    axes[0].plot(minutes, result['t5'] - 273, label='TIT (t5)')
+    axes[0].plot(minutes, result['t1'] - 273, label='Compressor inlet (t1)')
+    axes[0].set_ylabel('Temperature (°C)')
+    axes[0].legend(loc='best')
+    axes[0].grid(True)
+
+    axes[1].plot(minutes, result['Wnet'] / 1000000, color='g')
+    axes[1].set_ylabel('Net Work (MW)')
+    axes[1].grid(True)
+
+    axes[2].plot(minutes, result['E_cycle'] * 100, color='r')
+    axes[2].set_ylabel('Cycle Efficiency (%)')
+    axes[2].set_xlabel('Time (min)')
+    axes[2].grid(True)
+
+    axes[0].set_title(title)
+    plt.show()
+
+
+
+#T-s diagrams for the TIT sweep on a shared, cached background
+
+fig, ax = plt.subplots(figsize=(8, 6))
+plot_ts_background(ax)
+colors = plt.cm.viridis(np.linspace(0, 1, 10))
+ts_flash = WarmStartFlash()
+for t5, color in zip(np.linspace(460 + 273, 660 + 273, 10), colors):
+    plot_ts_cycle(ax, solve_cycle(t5 = t5, flash = ts_flash)['h'], color = color, points = False)
+ax.set_ylabel('Temperature (K)')
+ax.set_xlabel('Entropy (J/kg.K)')
+ax.set_title('T-s Diagram for Turbine Inlet Temperatures 460 - 660 °C')
+ax.grid(True)
+plt.show()
+
+
+
+#Off-Design / Part-Load Operation
+#The hardware is fixed at the design point of solve_cycle:
+#   turbine         Stodola ellipse, Mco2 = K_t*sqrt(rho5*p5*(1 - (p6/p5)**2)), constant Et
+#   compressors     constant speed, generic characteristic scaled to the design point, V = inlet volume flow:
+#                   R - 1 = (R_d - 1)*(1 + a_map*(1 - (V/V_d)**2)),   E = E_d*(1 - b_map*(V/V_d - 1)**2)
+#   HTR, LTR        fixed UA, counterflow, split into n_segments equal duty segments with the LMTD of each
+#Load is set by CO2 inventory control: TIT (t5) and compressor inlet temperature (t1) are held by the
+#heater and cooler, and the pressure levels float. Unknowns, relative to design: Mco2, p8, p5, p6, Q_HTR.
+#Solving for the recuperator duties (rather than t3 and t7) makes every state explicit, and a duty whose
+#temperature profiles touch or cross is rejected, so t3 < t7 and t4 < t6 on every iterate. Once the HTR duty
+#is known, both LTR inlets are too, and the LTR duty is solved inside each cycle evaluation: below ~85 % load
+#the LTR runs close to its pinch, where its UA balance is far too stiff to be a row of the Newton system.
+
+a_map = 0.3         #pressure ratio rise towards surge
+b_map = 0.5         #efficiency fall-off away from design flow
+n_segments = 10
+
+
+#UA a counterflow exchanger needs for duty Q, from the temperature profiles of both streams. Raises ValueError
+#if the duty is not positive or the streams pinch or cross, i.e. the duty is not reachable with any UA.
+def required_UA(flash, name, Q, Mco2, p_hot, h_hot_in, p_cold, h_cold_in, n = n_segments):
+    if Q <= 0:
+        raise ValueError(name + " duty is not positive")
+    dh = Q / Mco2 / n
+    # Hot stream from its inlet, cold stream towards its outlet: the points face each other along the exchanger
+    t_hot = [flash.T_PH(name + ' hot ' + str(k), p_hot, h_hot_in - k * dh) for k in range(n + 1)]
+    t_cold = [flash.T_PH(name + ' cold ' + str(k), p_cold, h_cold_in + (n - k) * dh) for k in range(n + 1)]
+    dT = np.array(t_hot) - np.array(t_cold)
+    if np.min(dT) <= 0:
+        raise ValueError(name + " temperature profiles cross, pinch = " + str(round(np.min(dT), 2)) + " K")
+    LMTD = np.where(np.abs(dT[1:] - dT[:-1]) < 1e-9, dT[1:], (dT[1:] - dT[:-1]) / np.log(dT[1:] / dT[:-1]))
+    return np.sum(Q / n / LMTD), np.min(dT)
+
+
+#Duty of a counterflow exchanger with fixed UA and given inlets. Q_end is the duty at which an end
+#temperature difference closes (hot outlet at the cold inlet temperature, or cold outlet at the hot inlet
+#temperature), and effec = Q/Q_end is passed in as the guess and returned for the next call. The required UA
+#rises monotonically with the duty up to the pinch, so the duty is bracketed between 0 and the lowest duty
+#found to pinch, and found by secant steps (stepping back towards the bracket when a step leaves it).
+def fixed_UA_duty(flash, name, UA, effec, Mco2, p_hot, h_hot_in, p_cold, h_cold_in, tol = 1e-10, max_iter = 30):
+    flash.state.update(CP.PT_INPUTS, p_hot, flash.T_PH(name + ' cold ' + str(n_segments), p_cold, h_cold_in))
+    h_hot_out_min = flash.state.hmass()
+    flash.state.update(CP.PT_INPUTS, p_cold, flash.T_PH(name + ' hot 0', p_hot, h_hot_in))
+    h_cold_out_max = flash.state.hmass()
+    Q_end = Mco2 * min(h_hot_in - h_hot_out_min, h_cold_out_max - h_cold_in)
+
+    Q_low, Q_high = 0, Q_end
+    Q = effec * Q_end
+    previous = None
+    for i in range(max_iter):
+        try:
+            UA_required, pinch = required_UA(flash, name, Q, Mco2, p_hot, h_hot_in, p_cold, h_cold_in)
+        except ValueError:      #profiles cross, the duty is too high; the root is usually just below
+            Q_high = Q
+            Q = Q_low + 0.9 * (Q_high - Q_low)
+            continue
+        error = 1 - UA / UA_required
+        if abs(error) < tol:
+            return Q, pinch, Q / Q_end
+        if error < 0:
+            Q_low = Q
+        else:
+            Q_high = Q
+
+        if previous is None:
+            Q_new = Q * (1 - 1e-4 * np.sign(error))
+        else:
+            Q_new = Q - error * (Q - previous[0]) / (error - previous[1])
+        previous = (Q, error)
+        if not Q_low < Q_new < Q_high:
+            Q_new = Q_low + 0.9 * (Q_high - Q_low) if error < 0 else (Q_low + Q_high) / 2
+        Q = Q_new
+    raise ValueError(name + " duty for the fixed UA did not converge")
+
+
+def finite_difference_jacobian(residual, x, r, step = 1e-6):
+    J = np.empty((len(r), len(x)))
+    for i in range(len(x)):
+        dx = np.zeros(len(x))
+        dx[i] = step
+        J[:, i] = (residual(x + dx) - r) / step
+    return J
+
+
+#Newton iterations with Broyden updates of the Jacobian. A Jacobian from the previous (neighbouring) load
+#point can be passed in as J. When backtracking finds no decrease, J first learns from the rejected trial
+#step (a Broyden update); it is only rebuilt by finite differences when backtracking fails twice in a row.
+def newton_broyden(residual, x0, J = None, tol = 1e-8, max_iter = 50):
+    x = np.array(x0, dtype = float)
+    try:
+        r = residual(x)
+    except ValueError as error:     #infeasible starting point, e.g. a recuperator pinch
+        raise RuntimeError("Part-load Newton iteration cannot start: " + str(error))
+    stats = {'evaluations': 1, 'jacobians': 0, 'iterations': 0}
+
+    def refresh(x, r):
+        stats['evaluations'] += len(x)
+        stats['jacobians'] += 1
+        return finite_difference_jacobian(residual, x, r)
+
+    if J is None:
+        J = refresh(x, r)
+
+    failures = 0
+    while np.max(np.abs(r)) > tol:
+        if stats['iterations'] >= max_iter:
+            raise RuntimeError("Part-load Newton iteration did not converge, residual = " + str(np.max(np.abs(r))))
+        stats['iterations'] += 1
+
+        dx = -np.linalg.solve(J, r)
+        step = 1.0
+        rejected = None
+        while step > 1 / 64:        #backtrack until the residual decreases
+            try:
+                r_new = residual(x + step * dx)
+                stats['evaluations'] += 1
+                if np.linalg.norm(r_new) < np.linalg.norm(r):
+                    break
+                rejected = (step * dx, r_new)
+            except ValueError:      #CoolProp flash outside the valid range, or a recuperator pinch
+                pass
+            step /= 2
+        else:
+            failures += 1
+            if failures == 2 or rejected is None:
+                J = refresh(x, r)   #Broyden Jacobian no longer gives a descent direction
+                failures = 0
+            else:
+                s, r_rejected = rejected
+                J = J + np.outer(r_rejected - r - J @ s, s) / (s @ s)
+            continue
+
+        failures = 0
+        s = step * dx
+        J = J + np.outer(r_new - r - J @ s, s) / (s @ s)
+        x = x + s
+        r = r_new
+
+    return x, J, stats
+
+
+#Each load is solved by continuation from the nearest load already converged (the design point is solved
+#first), extrapolated linearly when a second converged load lies behind it. If Newton fails, the step is
+#halved and the intermediate load is solved first, so the result does not depend on the order of loads.
+#Below ~85 % load the LTR hot side nears the pseudo-critical point and the LTR runs pinch limited; there the
+#required UA amplifies flash round-off, so the residuals are only converged to tol = 1e-6.
+def part_load_curve(loads, tol = 1e-6, min_step = 0.01, **design):
+    design_point = solve_cycle(**design)
+    flash = WarmStartFlash(h_tol = 1e-8, s_tol = 1e-11)     #UA from the LMTDs needs tight temperatures
+    state = CP.AbstractState('HEOS', 'CO2')
+
+    Et = design.get('Et', 0.9)
+    Ec_d = design.get('Ec', 0.85)
+    Epc_d = design.get('Epc', 0.85)
+    p5_d = design.get('p5', 250*100000)
+    p6_d = design.get('p6', 90*100000)
+    p8_d = design.get('p8', 120*100000)
+    t5 = design.get('t5', 560 + 273)
+    t1 = design.get('t1', 35 + 273)
+
+    # Design point states and hardware sizing
+    Mco2_d = design_point['Mco2']
+    Wnet_d = design_point['Wnet']
+    h1, h2, h3, h4, h5, h6, h7, h8, h9 = design_point['h']
+    t7_d = flash.T_PH('7', p6_d, h7)
+
+    state.update(CP.PT_INPUTS, p8_d, t1)
+    V1_d = Mco2_d / state.rhomass()
+    state.update(CP.PT_INPUTS, p6_d, t7_d)
+    V7_d = Mco2_d / state.rhomass()
+    state.update(CP.PT_INPUTS, p5_d, t5)
+    K_t = Mco2_d / np.sqrt(state.rhomass() * p5_d * (1 - (p6_d / p5_d)**2))
+
+    Rc_d = p5_d / p8_d
+    Rpc_d = p8_d / p6_d
+
+    Q_HTR_d = Mco2_d * (h6 - h7)
+    UA_HTR = required_UA(flash, 'HTR', Q_HTR_d, Mco2_d, p6_d, h6, p5_d, h3)[0]
+    Q_LTR_d = Mco2_d * (h8 - h9)
+    UA_LTR = required_UA(flash, 'LTR', Q_LTR_d, Mco2_d, p8_d, h8, p5_d, h2)[0]
+
+    LTR_effec = [fixed_UA_duty(flash, 'LTR', UA_LTR, 0.9, Mco2_d, p8_d, h8, p5_d, h2)[2]]
+
+    def cycle(x):
+        Mco2, p8, p5, p6, Q_HTR = x * [Mco2_d, p8_d, p5_d, p6_d, Q_HTR_d]
+
+        state.update(CP.PT_INPUTS, p8, t1)
+        h1, s1, rho1 = state.hmass(), state.smass(), state.rhomass()
+        state.update(CP.PT_INPUTS, p5, t5)
+        h5, s5, rho5 = state.hmass(), state.smass(), state.rhomass()
+
+        # Compressor
+        V1 = Mco2 / rho1 / V1_d
+        Rc = 1 + (Rc_d - 1) * (1 + a_map * (1 - V1**2))
+        Ec = Ec_d * (1 - b_map * (V1 - 1)**2)
+        h2 = ((flash.h_PS('2s', p5, s1) - h1) / Ec) + h1
+
+        # Turbine
+        h6 = h5 - (Et * (h5 - flash.h_PS('6s', p6, s5)))
+
+        # HTR hot side outlet
+        h7 = h6 - Q_HTR / Mco2
+        t7 = flash.T_PH('7', p6, h7)
+        state.update(CP.PT_INPUTS, p6, t7)
+        s7, rho7 = state.smass(), state.rhomass()
+
+        # Precompressor
+        V7 = Mco2 / rho7 / V7_d
+        Rpc = 1 + (Rpc_d - 1) * (1 + a_map * (1 - V7**2))
+        Epc = Epc_d * (1 - b_map * (V7 - 1)**2)
+        h8 = ((flash.h_PS('8s', p8, s7) - h7) / Epc) + h7
+
+        # LTR duty from its fixed UA, then the LTR and HTR energy balances
+        Q_LTR, pinch_LTR, LTR_effec[0] = fixed_UA_duty(flash, 'LTR', UA_LTR, LTR_effec[0], Mco2, p8, h8, p5, h2)
+        h3 = h2 + Q_LTR / Mco2
+        h4 = h3 + Q_HTR / Mco2
+        t3 = flash.T_PH('3', p5, h3)
+
+        UA_HTR_required, pinch_HTR = required_UA(flash, 'HTR', Q_HTR, Mco2, p6, h6, p5, h3)
+
+        Wnet = Mco2 * ((h5 - h6) - (h2 - h1) - (h8 - h7))
+        residuals = [(p5 / p8) / Rc - 1,
+                     (p8 / p6) / Rpc - 1,
+                     Mco2 / (K_t * np.sqrt(rho5 * p5 * (1 - (p6 / p5)**2))) - 1,
+                     1 - UA_HTR / UA_HTR_required]
+        results = {'Mco2': Mco2, 'p5': p5, 'p6': p6, 'p8': p8, 't3': t3, 't7': t7, 'Wnet': Wnet,
+                   'Q_heater': Mco2 * (h5 - h4), 'E_cycle': Wnet / (Mco2 * (h5 - h4)), 'Ec': Ec, 'Epc': Epc,
+                   'pinch_HTR': pinch_HTR, 'pinch_LTR': pinch_LTR}
+        return residuals, results
+
+    solved = {}     #load -> converged unknowns
+    stats = {}      #load -> Newton statistics of its solve
+    counts = {'evaluations': 0}
+
+    def load_residual(load):
+        def residual(x):
+            residuals, results = cycle(x)
+            return np.array(residuals + [results['Wnet'] / Wnet_d - load])
+        return residual
+
+    def predictor(load, residual, J):
+        # Candidate starts: the nearest converged load, its tangent from the carried Jacobian (only the load
+        # residual depends on the load, so dx/dload = J^-1 e_load), and the secant through the converged load
+        # behind it. The start with the smallest residual is used.
+        l_a = min(solved, key = lambda l: abs(l - load))
+        candidates = [solved[l_a]]
+        if J is not None:
+            candidates.append(solved[l_a] + np.linalg.solve(J, np.eye(5)[4]) * (load - l_a))
+        behind = [l for l in solved if (l - l_a) * (load - l_a) < 0]
+        if behind:
+            l_b = min(behind, key = lambda l: abs(l - l_a))
+            candidates.append(solved[l_a] + (solved[l_a] - solved[l_b]) * (load - l_a) / (l_a - l_b))
+
+        best = None
+        for x0 in candidates:
+            try:
+                r0 = np.max(np.abs(residual(x0)))
+            except ValueError:      #extrapolated past a pinch
+                continue
+            finally:
+                counts['evaluations'] += 1
+            if best is None or r0 < best[0]:
+                best = (r0, x0)
+        return l_a, best[1]
+
+    def solve(load, J, x0 = None):
+        residual = load_residual(load)
+        if x0 is None:
+            l_a, x0 = predictor(load, residual, J)
+            J = J * (solved[l_a] / x0)      #columns scaled to the new start, residuals are ~homogeneous in x
+        x, J, solve_stats = newton_broyden(residual, x0, J, tol)
+        solved[load] = x
+        stats[load] = solve_stats
+        counts['evaluations'] += solve_stats['evaluations']
+        return J
+
+    def continuation(load, J):
+        l_a = min(solved, key = lambda l: abs(l - load))
+        try:
+            return solve(load, J)
+        except RuntimeError:
+            if abs(load - l_a) < min_step:
+                raise
+            return continuation(load, continuation((load + l_a) / 2, J))
+
+    J = solve(1.0, None, np.ones(5))    #design point, exact by construction
+    for load in loads:
+        if load not in solved:
+            J = continuation(load, J)
+
+    curve = {key: [] for key in ['load', 'Mco2', 'p5', 'p6', 'p8', 't3', 't7', 'Wnet', 'Q_heater', 'E_cycle',
+                                 'Ec', 'Epc', 'pinch_HTR', 'pinch_LTR', 'iterations', 'jacobians']}
+    for load in loads:
+        results = cycle(solved[load])[1]
+        curve['load'].append(load)
+        for key in results:
+            curve[key].append(results[key])
+        curve['iterations'].append(stats[load]['iterations'])
+        curve['jacobians'].append(stats[load]['jacobians'])
+
+    print("Part-load curve:", len(loads), "load points,", len(solved), "solved,", counts['evaluations'],
+          "cycle evaluations,", sum(s['jacobians'] for s in stats.values()), "finite difference Jacobians")
+    for load in stats:      #in the order solved, including intermediate loads
+        print("   load", round(load, 4), ":", stats[load]['iterations'], "iterations,", stats[load]['jacobians'],
+              "Jacobians,", stats[load]['evaluations'], "evaluations")
+    print()
+    flash.report("Part-load curve")
+
+    return {key: np.array(values) for key, values in curve.items()}
+
+
+#Part-load curve 100 % -> 20 %
+
+part_load = part_load_curve(np.linspace(1, 0.2, 17))
+
+#plotting part-load performance
+
+fig, axes = plt.subplots(2, 1, figsize=(8, 8), sharex=True)
+axes[0].plot(part_load['load'] * 100, part_load['E_cycle'] * 100, marker='o', color='b')
+axes[0].set_ylabel('Cycle Efficiency (%)')
+axes[0].grid(True)
+axes[0].set_title('Part-Load Performance (inventory control)')
+
+axes[1].plot(part_load['load'] * 100, part_load['p5'] / 100000, marker='o', label='p5')
+axes[1].plot(part_load['load'] * 100, part_load['p8'] / 100000, marker='s', label='p8')
+axes[1].plot(part_load['load'] * 100, part_load['p6'] / 100000, marker='^', label='p6')
+axes[1].set_ylabel('Pressure (bar)')
+axes[1].set_xlabel('Load (% of design net work)')
+axes[1].legend(loc='best')
+axes[1].grid(True)
+plt.show()
+
+
+
+#Global Sensitivity Analysis (Sobol Indices)
+#Saltelli sampling: matrices A and B come from a scrambled Sobol sequence over the parameter ranges, and
+#each AB_i is A with column i taken from B, so every sample row needs d + 2 cycle solves.
+#   first order  S_i  = mean(f_B*(f_ABi - f_A)) / Var(f)          (Saltelli 2010)
+#   total        ST_i = mean((f_A - f_ABi)**2) / (2*Var(f))       (Jansen)
+#Confidence intervals are bootstrap percentiles over the sample rows. The sample is doubled until every
+#interval is narrower than +- tol, or max_N rows are reached.
+#Batches are solved on all cores with forked worker processes on Linux. Elsewhere fork is either missing
+#(Windows) or unsafe once matplotlib has opened figures (macOS), and spawned workers would re-run this whole
+#script, so the samples are solved in this process instead.
+#The default run needs about 82k cycle solves (3.5 min on one core), so it only runs with sobol_study = True.
+
+sobol_study = False
+
+sobol_parameters = {'Et': (0.85, 0.95),
+                    'Ec': (0.80, 0.90),
+                    'Epc': (0.80, 0.90),
+                    'effec_HTR': (0.70, 0.90),
+                    't1': (32 + 273, 40 + 273),
+                    't3': (240 + 273, 290 + 273),
+                    'p6': (80*100000, 100*100000),
+                    'p8': (110*100000, 130*100000)}
+sobol_outputs = ['E_cycle', 'Wnet']
+
+
+def evaluate_samples(X, names):
+    f = np.full((len(X), len(sobol_outputs)), np.nan)
+    flash = WarmStartFlash()    #one per chunk, a worker process does not share it with the others
+    for k, row in enumerate(X):
+        try:
+            results = solve_cycle(**dict(zip(names, row)), flash = flash)
+            f[k] = [results[output] for output in sobol_outputs]
+        except ValueError:      #CoolProp flash failed, the row is dropped from the estimates
+            pass
+    return f
+
+
+def sobol_indices(f_A, f_B, f_AB):
+    # Centring the outputs does not change the indices but keeps the first order estimator's variance low
+    mean = np.mean(np.concatenate([f_A, f_B]), axis=0)
+    f_A, f_B, f_AB = f_A - mean, f_B - mean, f_AB - mean
+    var = np.var(np.concatenate([f_A, f_B]), axis=0)
+    S1 = np.mean(f_B * (f_AB - f_A), axis=1) / var
+    ST = 0.5 * np.mean((f_A - f_AB)**2, axis=1) / var
+    return S1, ST
+
+
+def sobol_analysis(parameters = sobol_parameters, N0 = 256, max_N = 16384, tol = 0.02,
+                   n_bootstrap = 200, workers = None, seed = 0):
+    names = list(parameters)
+    d = len(names)
+    lower = [parameters[name][0] for name in names]
+    upper = [parameters[name][1] for name in names]
+    sampler = qmc.Sobol(2 * d, scramble = True, seed = seed)
+    rng = np.random.default_rng(seed)
+
+    workers = workers or os.cpu_count()
+    pool = None
+    if sys.platform.startswith('linux'):
+        pool = ProcessPoolExecutor(workers, mp_context = multiprocessing.get_context('fork'))
+
+    def evaluate_batched(X):
+        if pool is None:
+            return evaluate_samples(X, names)
+        chunks = np.array_split(X, 4 * workers)
+        return np.concatenate(list(pool.map(evaluate_samples, chunks, [names] * len(chunks))))
+
+    f_A = np.empty((0, len(sobol_outputs)))
+    f_B = np.empty((0, len(sobol_outputs)))
+    f_AB = np.empty((d, 0, len(sobol_outputs)))
+    start = time.time()
+
+    try:
+        n_new = N0
+        while True:
+            # Extend A, B and AB_i with the next n_new rows of the Sobol sequence (doubling keeps it balanced)
+            samples = qmc.scale(sampler.random(n_new), lower * 2, upper * 2)
+            A = samples[:, :d]
+            B = samples[:, d:]
+            AB = np.repeat(A[np.newaxis], d, axis=0)
+            for i in range(d):
+                AB[i, :, i] = B[:, i]
+
+            f = evaluate_batched(np.concatenate([A, B, AB.reshape(-1, d)]))
+            f_A = np.concatenate([f_A, f[:n_new]])
+            f_B = np.concatenate([f_B, f[n_new:2 * n_new]])
+            f_AB = np.concatenate([f_AB, f[2 * n_new:].reshape(d, n_new, -1)], axis=1)
+
+            valid = ~(np.isnan(f_A).any(axis=1) | np.isnan(f_B).any(axis=1) | np.isnan(f_AB).any(axis=(0, 2)))
+            S1, ST = sobol_indices(f_A[valid], f_B[valid], f_AB[:, valid])
+
+            rows = np.flatnonzero(valid)
+            S1_boot = np.empty((n_bootstrap,) + S1.shape)
+            ST_boot = np.empty((n_bootstrap,) + ST.shape)
+            for b in range(n_bootstrap):
+                resample = rng.choice(rows, len(rows))
+                S1_boot[b], ST_boot[b] = sobol_indices(f_A[resample], f_B[resample], f_AB[:, resample])
+            S1_conf = np.percentile(S1_boot, [2.5, 97.5], axis=0)
+            ST_conf = np.percentile(ST_boot, [2.5, 97.5], axis=0)
+
+            N = len(f_A)
+            half_width = max(np.max(S1_conf[1] - S1_conf[0]), np.max(ST_conf[1] - ST_conf[0])) / 2
+            print("Sobol analysis: N =", N, ",", N * (d + 2), "cycle evaluations,", round(time.time() - start, 1),
+                  "s, widest 95 % interval = +-", round(half_width, 4))
+
+            if half_width < tol or 2 * N > max_N:
+                break
+            n_new = N
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    print()
+    for k, output in enumerate(sobol_outputs):
+        print("Sobol indices for", output, "(95 % bootstrap intervals):")
+        for i, name in enumerate(names):
+            print("   ", name.ljust(10),
+                  "S1 = %6.3f [%6.3f, %6.3f]" % (S1[i, k], S1_conf[0, i, k], S1_conf[1, i, k]),
+                  "  ST = %6.3f [%6.3f, %6.3f]" % (ST[i, k], ST_conf[0, i, k], ST_conf[1, i, k]))
+        print()
+
+    return {'names': names, 'N': N, 'S1': S1, 'ST': ST, 'S1_conf': S1_conf, 'ST_conf': ST_conf}
+
+
+if sobol_study:
+    sensitivity = sobol_analysis()
+
+    #plotting first order and total Sobol indices
+
+    x_index = np.arange(len(sensitivity['names']))
+    for k, output in enumerate(sobol_outputs):
+        plt.figure(figsize=(8, 6))
+        for offset, index, label in [(-0.2, 'S1', 'First order'), (0.2, 'ST', 'Total')]:
+            value = sensitivity[index][:, k]
+            conf = sensitivity[index + '_conf'][:, :, k]
+            plt.bar(x_index + offset, value, width=0.4, label=label,
+                    yerr=[value - conf[0], conf[1] - value], capsize=3)
+        plt.xticks(x_index, sensitivity['names'])
+        plt.ylabel('Sobol Index')
+        plt.grid(True, axis='y')
+        plt.legend(loc='upper right')
+        plt.title('Sensitivity of ' + output + ' (N = ' + str(sensitivity['N']) + ')')
+        plt.show()